@@ -5,10 +5,15 @@ The script cleans the HTML content of the messages, formats the messages and the
 and prints the formatted messages.
 
 The script fetches all messages and their replies from the specified channel and then filters the messages by date in Python. We have to filter after fetching all the contents because the Microsoft Graph API does not currently support the createdDateTime filter query parameter for the /messages endpoint.
-The date filter in Python skips any messages that were created before the specified date.
+The date filter in Python skips any messages that were created before the specified date. Because Graph returns messages
+newest first, the script stops requesting pages once it reaches a page whose oldest message predates the specified date.
+
+Pages are fetched asynchronously: the request for the next page is started as soon as its @odata.nextLink is known, so it
+downloads while the current page is being processed. Messages whose replies were not fully expanded inline have their
+remaining reply pages fetched concurrently through the Graph $batch endpoint.
 
 To run this script:
-1. Ensure that you have Python 3 and the required packages (requests, json, html, re, bs4, python-dotenv) installed.
+1. Ensure that you have Python 3 and the required packages (httpx[http2], orjson, lxml, python-dotenv) installed.
 2. Obtain an access token by logging in to the Graph Explorer (https://developer.microsoft.com/en-us/graph/graph-explorer) and copying the token from the 'Access token' panel. This token has a short lifespan, so expect to regen it often.
 3. Replace the values in the .env file with your actual ACCESS_TOKEN, GROUP_ID, and CHANNEL_ID.
 4. Save the .env file in the same directory as this script.
@@ -19,14 +24,14 @@ License: MIT
 '''
 
 import os
-import requests
-import json
-import html
-import re
+import asyncio
+import httpx
+import orjson
 import sys
 from datetime import datetime
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
+from lxml import etree
+from lxml import html as lhtml
 
 # Load environment variables from .env file
 load_dotenv()
@@ -46,83 +51,234 @@ else:
     # Default to today's date if no date was provided and set the time to '00:00:00'
     date_from = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
 
+# The date as an ISO 8601 string (YYYY-MM-DD) for comparing against Graph's createdDateTime values
+date_from_iso = date_from.date().isoformat()
+
 # Get the messages and their replies
-url = f'https://graph.microsoft.com/beta/teams/{group_id}/channels/{channel_id}/messages?$expand=replies'
+graph_url = 'https://graph.microsoft.com/beta'
+# Only the fields used below are selected to keep the responses small, and pages are requested at
+# Graph's maximum size of 50 messages to minimize the number of round trips.
+message_fields = 'id,createdDateTime,lastModifiedDateTime,body'
+reply_fields = 'id,createdDateTime,body'
+url = (f'{graph_url}/teams/{group_id}/channels/{channel_id}/messages'
+       f'?$top=50&$select={message_fields}&$expand=replies($select={reply_fields})')
 headers = {'Authorization': 'Bearer ' + access_token}
 
-# Initialize the list of formatted messages
-formatted_messages = []
+# Translation table replacing non-breaking spaces with regular spaces
+_TRANS = str.maketrans({'\u00a0': ' '})
+
+# Clean the HTML from a message or reply body: replace each <a> tag that has an href attribute with a
+# Markdown link, then take the text content of the document, which drops all remaining HTML tags and
+# unescapes entities in a single pass in lxml's C code. Finally replace non-breaking spaces.
+# The helpers are bound as default arguments so each call looks them up as fast locals rather than globals.
+def _clean(body, _fromstring=lhtml.fromstring, _trans=_TRANS):
+    content = body['content']
+    if not content:
+        return ''
+
+    try:
+        doc = _fromstring(content)
+    except etree.ParserError:
+        # The content had no elements or text, e.g. only whitespace
+        return ''
+
+    for a_tag in list(doc.iter('a')):
+        href = a_tag.get('href')
+        if href:
+            # Replace the link's contents with its Markdown form, keeping the text that follows the tag
+            tail = a_tag.tail
+            text = a_tag.text_content()
+            a_tag.clear()
+            a_tag.text = f"[{text}]({href})"
+            a_tag.tail = tail
+
+    return doc.text_content().translate(_trans)
+
+# Maximum number of requests in flight against the Graph API at once. Keep this modest to stay under Graph's throttling limits.
+max_concurrent_requests = 4
+
+# The Graph $batch endpoint accepts at most 20 subrequests per call
+max_batch_size = 20
 
-# Iterate over the pages of messages
-while url:
-    response = requests.get(url, headers=headers)
-    # print("Status code:", response.status_code)
-    # print("Response text:", response.text)
-    data = response.json()
+# Graph throttles with 429 and reports temporary unavailability with 503; both carry a Retry-After header
+# and are retried up to max_retries times
+retryable_statuses = (429, 503)
+max_retries = 5
 
-    # Save @odata.count and @odata.nextLink if they exist
-    # for use in iterating over the pages of messages
-    odata_count = data.get('@odata.count')
-    odata_nextLink = data.get('@odata.nextLink')
+# Seconds to wait before retrying a throttled request: the Retry-After header if Graph sent one,
+# otherwise an exponential backoff
+def retry_delay(retry_after, retry_count):
+    if retry_after and str(retry_after).isdigit():
+        return int(retry_after)
+    return 2 ** retry_count
 
-    messages = data.get('value', [])
+# Send a request to Graph and return the decoded JSON response, retrying throttled requests.
+# Any other error status raises, so a failed request ends the export instead of silently truncating it.
+# orjson decodes the raw bytes directly, which is considerably faster than the standard library for pages
+# with expanded replies.
+async def request_json(client, semaphore, method, url, **kwargs):
+    for retry_count in range(max_retries + 1):
+        async with semaphore:
+            response = await client.request(method, url, **kwargs)
+        # print("Status code:", response.status_code)
+        # print("Response text:", response.text)
 
-    for message in messages:
-        # Convert the message's createdDateTime to a datetime object without fractional seconds
-        # Convert the message's createdDateTime to a date object
-        message_date = datetime.strptime(message['createdDateTime'].split('T')[0], '%Y-%m-%d').date()
+        if response.status_code not in retryable_statuses or retry_count == max_retries:
+            break
 
-        # print("Message Date: ", message_date)
-        # print("Date From: ", date_from)
+        delay = retry_delay(response.headers.get('Retry-After'), retry_count)
+        print(f"Graph returned {response.status_code}, retrying in {delay} seconds...", file=sys.stderr)
+        await asyncio.sleep(delay)
 
-        # Skip this message if it's older than the specified date
-        if message_date < date_from.date():
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+# Fetch a Graph URL and return the decoded JSON response
+async def fetch_json(client, semaphore, url):
+    return await request_json(client, semaphore, 'GET', url)
+
+# Fetch the next page of replies for each of the given messages in a single $batch request.
+# Returns the messages that still have more replies to fetch, including those whose subrequest was throttled.
+async def fetch_replies_batch(client, semaphore, messages):
+    batch = {
+        "requests": [
+            {
+                "id": str(index),
+                "method": "GET",
+                # Subrequest URLs are relative to the Graph version root
+                "url": message['replies@odata.nextLink'].removeprefix(graph_url)
+            }
+            for index, message in enumerate(messages)
+        ]
+    }
+
+    data = await request_json(client, semaphore, 'POST', f'{graph_url}/$batch', json=batch)
+
+    pending = []
+    delay = 0
+    for subresponse in data.get('responses', []):
+        message = messages[int(subresponse['id'])]
+        body = subresponse.get('body', {})
+        status = subresponse.get('status')
+
+        # Graph throttles $batch subrequests individually. Retry them in the next batch once their Retry-After has passed.
+        retry_count = message.get('_reply_retries', 0)
+        if status in retryable_statuses and retry_count < max_retries:
+            message['_reply_retries'] = retry_count + 1
+            delay = max(delay, retry_delay((subresponse.get('headers') or {}).get('Retry-After'), retry_count))
+            pending.append(message)
             continue
 
-        # Clean the HTML from the message content
-        message_content = html.unescape(message['body']['content']) if message['body']['content'] else ''
-        message_content = message_content.replace('\u00a0', ' ')
-
-        # Parse the message content as HTML
-        soup = BeautifulSoup(message_content, 'html.parser')
-
-        # For each <a> tag in the message content
-        for a_tag in soup.find_all('a'):
-            # If the <a> tag has an href attribute
-            if 'href' in a_tag.attrs:
-                # Replace the <a> tag with its href attribute formatted as a Markdown link
-                a_tag.replace_with(f"[{a_tag.text}]({a_tag['href']})")
-
-        # Convert the parsed HTML back to a string and remove all HTML tags
-        message_content = re.sub('<[^<]+?>', '', str(soup))
-
-        # Format the message and its replies
-        formatted_message = {
-            "messageId": message['id'],
-            "messageDateTime": message['createdDateTime'],
-            "messageContent": message_content,
-            "replies": [
-                {
-                    "replyId": reply['id'],
-                    "replyDateTime": reply['createdDateTime'],
-                    "replyContent": (re.sub('<[^<]+?>', '', html.unescape(reply['body']['content'])) if reply['body']['content'] else '').replace('\u00a0', ' ')
-                }
-                for reply in message['replies']
-            ]
-        }
+        if status != 200:
+            print(f"Failed to fetch replies for message {message['id']}: {body}", file=sys.stderr)
+            continue
+
+        # Append this page of replies and remember where the next page is, if there is one
+        message['replies'].extend(body.get('value', []))
+        message['replies@odata.nextLink'] = body.get('@odata.nextLink')
+        message['_reply_retries'] = 0
+        if message['replies@odata.nextLink']:
+            pending.append(message)
 
-        # Add the formatted message to the list
-        formatted_messages.append(formatted_message)
+    if delay:
+        print(f"Graph throttled reply requests, retrying in {delay} seconds...", file=sys.stderr)
+        await asyncio.sleep(delay)
 
-    # Update the URL to the next page URL
-    url = odata_nextLink
+    return pending
 
-# Print the formatted messages as JSON
-json_output = json.dumps({"messages": formatted_messages}, indent=2)
-print(json_output)
+# Graph only expands a limited number of replies inline. Fetch the rest for any message that has a
+# replies@odata.nextLink, running up to max_batch_size reply pages per $batch request and the batches concurrently.
+async def fetch_remaining_replies(client, semaphore, messages):
+    pending = [message for message in messages if message.get('replies@odata.nextLink')]
+
+    while pending:
+        batches = [pending[i:i + max_batch_size] for i in range(0, len(pending), max_batch_size)]
+        results = await asyncio.gather(*[fetch_replies_batch(client, semaphore, batch) for batch in batches])
+        pending = [message for result in results for message in result]
+
+# Iterate over the pages of messages and yield each formatted message as soon as its page is processed
+async def iter_messages():
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+    # Bind the globals used for every message to locals once, outside the page loop
+    clean = _clean
+    date_from_str = date_from_iso
+
+    # Use a single client for every request so connections to Graph are kept alive and reused rather than
+    # paying a new TCP and TLS handshake per page. The pool is sized to the number of concurrent requests.
+    limits = httpx.Limits(max_connections=max_concurrent_requests, max_keepalive_connections=max_concurrent_requests)
+
+    async with httpx.AsyncClient(http2=True, headers=headers, limits=limits, timeout=60) as client:
+        next_page = asyncio.create_task(fetch_json(client, semaphore, url))
+
+        while next_page:
+            data = await next_page
+
+            page = data.get('value', [])
+
+            # Graph returns messages newest first, so once the oldest message on a page predates the
+            # specified date, every message on the following pages does too and there is no need to fetch them.
+            # lastModifiedDateTime is never earlier than createdDateTime, so it is a safe bound whether
+            # Graph orders by creation or by modification time.
+            odata_nextLink = data.get('@odata.nextLink')
+            if page and (page[-1].get('lastModifiedDateTime') or page[-1]['createdDateTime']) < date_from_str:
+                odata_nextLink = None
+
+            # Graph pagination is a linked list, so the next page can only be requested once
+            # @odata.nextLink is known. Start it now so it downloads while this page is processed.
+            next_page = asyncio.create_task(fetch_json(client, semaphore, odata_nextLink)) if odata_nextLink else None
+
+            # Skip messages that are older than the specified date. ISO 8601 timestamps sort lexically, so
+            # comparing the raw createdDateTime string against the date avoids parsing it.
+            messages = [message for message in page if message['createdDateTime'] >= date_from_str]
+
+            # Fetch any replies that were not expanded inline
+            await fetch_remaining_replies(client, semaphore, messages)
+
+            for message in messages:
+                # Format the message and its replies
+                yield {
+                    "messageId": message['id'],
+                    "messageDateTime": message['createdDateTime'],
+                    "messageContent": clean(message['body']),
+                    "replies": [
+                        {
+                            "replyId": reply['id'],
+                            "replyDateTime": reply['createdDateTime'],
+                            "replyContent": clean(reply['body'])
+                        }
+                        for reply in message['replies']
+                    ]
+                }
+
+# Stream the formatted messages to each of the outputs as a single JSON document. Each message is
+# written as soon as it is formatted, so only the current page is held in memory.
+async def fetch_all(outputs):
+    def write(chunk):
+        for output in outputs:
+            output.write(chunk)
+
+    write(b'{"messages": [')
+    separator = b'\n'
+    async for formatted_message in iter_messages():
+        write(separator + orjson.dumps(formatted_message, option=orjson.OPT_INDENT_2))
+        separator = b',\n'
+    write(b'\n]}\n')
 
 # Check if a file name was provided as a command line argument
 if len(sys.argv) > 1:
-    # Write the output to the file
-    with open(sys.argv[1], 'w') as f:
-        print(json_output, file=f)
\ No newline at end of file
+    # Print the formatted messages as JSON and write them to the file. The messages are streamed into a
+    # temporary file that only replaces the output file once the export has finished, so a failed export
+    # (e.g. the access token expiring partway through) never leaves a truncated JSON document behind.
+    tmp_path = sys.argv[1] + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            asyncio.run(fetch_all([sys.stdout.buffer, f]))
+        os.replace(tmp_path, sys.argv[1])
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+else:
+    # Print the formatted messages as JSON
+    asyncio.run(fetch_all([sys.stdout.buffer]))
@@ -8,10 +8,21 @@ The script accepts two command-line arguments:
 1. 'input_file': The path to the input JSON file.
 2. 'output_dir': The path to the output directory where the question-answer pair files will be saved.
 
+Requests to the OpenAI API are sent concurrently. The optional '--max-concurrent' argument limits how many
+are in flight at once (default 8); lower it if the deployment's rate limits are being hit.
+Messages longer than about 2000 tokens are split into chunks, and the questions extracted from each chunk are merged
+before the answers are generated.
+
+With the optional '--batch' argument, the requests are instead submitted through the Azure OpenAI Batch API,
+which processes them offline at a lower cost and completes within 24 hours. The script polls until the
+questions batch finishes, then submits the answers batch. The API version must support batches
+(2024-07-01-preview or later).
+
 The script uses environment variables for OpenAI API configuration, which should be set in a .env file:
 1. 'AZURE_OPENAI_API_KEY': The OpenAI API key.
 2. 'AZURE_OPENAI_ENDPOINT': The OpenAI API endpoint.
 3. 'AZURE_OPENAI_DEPLOYMENT_NAME': The name of the OpenAI deployment.
+4. 'AZURE_OPENAI_API_VERSION': The OpenAI API version.
 
 How to run:
 1. Ensure that all the necessary Python libraries are installed and the .env file is set up correctly.
@@ -23,20 +34,57 @@ License: MIT
 """
 
 import json
+import orjson
 import os
 import re
+import sys
 import argparse
 import openai
 import asyncio
+import aiofiles
+import random
+import requests
+import tiktoken
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
-openai.api_key = os.getenv("AZURE_OPENAI_API_KEY")
-openai.api_base = os.getenv("AZURE_OPENAI_ENDPOINT")
+# Read the Azure OpenAI configuration once rather than on every request
+_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
+_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
+_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION")
+_ENGINE = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
+
+openai.api_key = _API_KEY
+openai.api_base = _ENDPOINT
 openai.api_type = "azure"
-openai.api_version = os.get("AZURE_OPENAI_API_VERSION")
+openai.api_version = _API_VERSION
+
+# Check that all of the Azure OpenAI configuration is set, rather than passing None into the OpenAI client
+def check_config():
+    missing = [name for name, value in (
+        ("AZURE_OPENAI_API_KEY", _API_KEY),
+        ("AZURE_OPENAI_ENDPOINT", _ENDPOINT),
+        ("AZURE_OPENAI_API_VERSION", _API_VERSION),
+        ("AZURE_OPENAI_DEPLOYMENT_NAME", _ENGINE),
+    ) if not value]
+    if missing:
+        print(f"Missing environment variables: {', '.join(missing)}. Set them in the .env file.", file=sys.stderr)
+        sys.exit(1)
+
+max_retry_delay = 60  # Upper bound on the backoff delay between retries in seconds
+batch_poll_interval = 60  # Delay between Batch API status checks in seconds
+file_poll_interval = 5  # Delay between status checks of an uploaded batch input file in seconds
+max_chunk_tokens = 2000  # Maximum size of each chunk of message content sent for question extraction
+
+# Tokenizer used to measure message content when splitting it into chunks. It is loaded on first use,
+# since tiktoken downloads the encoding the first time and short messages don't need it at all.
+_encoding = None
+
+# Boundaries to split oversized text at, from the most to the least natural: line breaks, the end of a
+# sentence, then any whitespace. The separators are kept, so joining the pieces gives back the text.
+_SPLIT_PATTERNS = [re.compile(r'(?<=\n)'), re.compile(r'(?<=[.!?])(?=\s)'), re.compile(r'(?=\s)')]
 
 # # Define a prompt for OpenAI API to generate questions and 
 question_prompt = """Given the following input, extract and summarize the questions being asked. Clean up the formatting to remove extraneous characters and improve readability. Distill each question down to the essence of what is being asked, removing extraneous information and formatting. Do not include anyone's names in the output. Format the output using the following template, with each question forming a unique item as shown in the example below:
@@ -58,115 +106,334 @@ answers_prompt = """Given the following question and answers, extract and synthe
   ...
 """
 
-# Check if a string is a valid JSON object
-def is_valid_json(json_string):
-    try:
-        json.loads(json_string)
-        return True
-    except ValueError:
-        print("Invalid JSON:", json_string)
-        return False
+# Delay before the given retry: exponential backoff capped at max_retry_delay, with random jitter so
+# concurrent requests that were throttled together don't all retry at the same moment.
+def backoff_delay(retry_count):
+    return min(max_retry_delay, 2 ** retry_count + random.random())
 
 # Generate questions and answers: generate_qna() is an async 
 # function that sends request to OpenAI API to generate QnA based on input.
 # Retries request if response is invalid, up to a maximum number of attempts.
-async def generate_qna(input, prompt):
+# The semaphore limits how many requests are in flight at once, to stay within the deployment's rate limits.
+async def generate_qna(input, prompt, semaphore):
     max_retries = 3
     retry_count = 0
-    retry_delay = 2  # Delay between retries in seconds
     system_prompt = prompt
 
     while retry_count < max_retries:
         try:
             print(f"Attempt {retry_count + 1} of {max_retries}...")
-            response = openai.ChatCompletion.create(
-                engine=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": input},
-                ],
-                max_tokens=4096,
-                n=1,
-                stop=None,
-                temperature=0.1,
-                top_p=0.1,
-            )
+            # Hold a semaphore slot only while the request is in flight, so retry delays don't block other requests
+            async with semaphore:
+                response = await openai.ChatCompletion.acreate(
+                    engine=_ENGINE,
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": input},
+                    ],
+                    max_tokens=4096,
+                    n=1,
+                    stop=None,
+                    temperature=0.1,
+                    top_p=0.1,
+                )
             return response.choices[0].message.content
         except openai.error.Timeout:
-            if retry_count < max_retries - 1:  # If we haven't reached the maximum number of retries
-                print(f"Request timed out, retrying (attempt {retry_count + 1})...")
-                await asyncio.sleep(retry_delay)  # Wait before retrying
-                continue  # Retry the request
-            else:  # If we've reached the maximum number of retries
-                print(f"Request timed out after {max_retries} attempts. Skipping Q&A for this chunk.")
-                return "{}"  # Return an empty JSON string as a fallback
+            print(f"Request timed out (attempt {retry_count + 1}).")
+            delay = backoff_delay(retry_count)
+        except (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.APIError) as e:
+            # Rate limits and server errors are retried with exponential backoff. When the service says how long
+            # to wait, via the Retry-After header or the error message, wait at least that long.
+            retry_after = (getattr(e, 'headers', None) or {}).get('Retry-After')
+            delay_str = re.search(r'Please retry after (\d+)', str(e))
+            delay = backoff_delay(retry_count)
+            if retry_after and str(retry_after).isdigit():
+                delay = max(int(retry_after), delay)
+            elif delay_str:
+                delay = max(int(delay_str.group(1)), delay)
+            print(f"{type(e).__name__} (attempt {retry_count + 1}): {e}")
         except Exception as e:  # Catch all other exceptions
-                error_message = str(e)
-                delay_str = re.search(r'Please retry after (\d+)', error_message)
-                if delay_str:
-                    delay = int(delay_str.group(1))
-                    print(f"Rate limit exceeded. Retrying in {delay} seconds...")
-                    await asyncio.sleep(delay)
-                    retry_count += 1
-                else:
-                    print(f"An error occurred: {e}")
-                    return "{}"  # Return an empty JSON string as a fallback
-        
+            print(f"An error occurred: {e}")
+            return "{}"  # Return an empty JSON string as a fallback
+
         retry_count += 1
 
-        if retry_count < max_retries - 1:
-            await asyncio.sleep(retry_delay)
+        if retry_count < max_retries:
+            print(f"Retrying in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
 
     print(f"Failed to get a valid response after {max_retries} attempts. Skipping Q&A for this chunk.")
     return "{}"  # Return an empty JSON string as a fallback
 
-async def extract_qa_pairs(input_file, output_dir):
+# Load the input file and return the messages that have replies to extract Q&A from
+def load_items(input_file):
     with open(input_file, 'r') as f:
         data = json.load(f)
 
-    counter = 0  # Initialize the counter
-
+    items = []
     for item in data['messages']:
         # Skip this message if there are no replies
         if not item['replies']:
             print("No replies to message, skipping messageId ", item['messageId'])
             continue
-        message_id = item['messageId']
-        message_content = item['messageContent']
-        replies = item['replies']
-        answers = [reply['replyContent'] for reply in replies]
-        answer_content = ' '.join(answers)
-
-        questions = await generate_qna(message_content, question_prompt)
-        answers = await generate_qna(questions + '\n' + answer_content, answers_prompt)
-        print("Message ID:", message_id)
-        print("Questions:", questions)
-        print("Answers:", answers)
-
-        # Create a dictionary for this pair of questions and answers
-        if (is_valid_json(questions) and is_valid_json(answers)):
-            question_list = json.loads(questions)
-            question_list = [{"Q" + str(counter): question["question"]} for question in question_list]
-            answer_list = [{"A" + str(counter): answer["answer"]} for answer in json.loads(answers)]
-                
-            pair = {
-                "Questions": question_list,
-                "Answers": answer_list
-            }
-
-            # Create a new file for each pair
-            with open(os.path.join(output_dir, f'qna_{counter}.json'), 'w') as f:
-                f.write(json.dumps(pair, indent=4))
-
-            counter += 1  # Increment the counter
-        else:
-            print("Invalid JSON returned from chat function, skipping this pair.")
+        items.append(item)
+
+    return items
+
+# Return the tokenizer, loading it on first use. Exit with a clear message if it can't be loaded,
+# e.g. when the encoding has not been downloaded yet and there is no network access.
+def get_encoding():
+    global _encoding
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception as e:
+            print(f"Failed to load the tiktoken cl100k_base encoding needed to split long messages: {e}", file=sys.stderr)
+            sys.exit(1)
+    return _encoding
+
+# Split text into pieces of at most max_tokens tokens each, at the most natural boundary that makes them fit.
+# Yields (piece, token_count) pairs. Text with no boundary left is halved by characters, which never
+# splits a multi-byte character.
+def split_text(text, max_tokens, level=0):
+    # Count special-token strings such as <|endoftext|> as plain text, since messages may quote them
+    token_count = len(get_encoding().encode(text, disallowed_special=()))
+    if token_count <= max_tokens:
+        yield text, token_count
+        return
+
+    while level < len(_SPLIT_PATTERNS):
+        pieces = [piece for piece in _SPLIT_PATTERNS[level].split(text) if piece]
+        level += 1
+        if len(pieces) > 1:
+            for piece in pieces:
+                yield from split_text(piece, max_tokens, level)
+            return
+
+    middle = len(text) // 2
+    yield from split_text(text[:middle], max_tokens, level)
+    yield from split_text(text[middle:], max_tokens, level)
+
+# Split text into chunks of at most max_tokens tokens, breaking at line breaks where possible, then at
+# sentence ends, then at whitespace.
+def chunk_text(text, max_tokens=max_chunk_tokens):
+    # Every token covers at least one byte, so short text always fits in one chunk and needn't be tokenized
+    if len(text.encode()) <= max_tokens:
+        return [text]
+
+    chunks = []
+    current = []
+    current_tokens = 0
+
+    for piece, token_count in split_text(text, max_tokens):
+        if current and current_tokens + token_count > max_tokens:
+            chunks.append(''.join(current))
+            current = []
+            current_tokens = 0
+
+        current.append(piece)
+        current_tokens += token_count
+
+    if current:
+        chunks.append(''.join(current))
+
+    return chunks or [text]
+
+# Merge the questions generated for each chunk of a message into a single JSON list.
+# Chunks whose output is not a valid JSON list are skipped.
+def merge_questions(results):
+    if len(results) == 1:
+        return results[0]
+
+    questions = []
+    for result in results:
+        try:
+            chunk_questions = orjson.loads(result)
+        except orjson.JSONDecodeError as e:
+            print(f"Invalid JSON returned from chat function ({e}), skipping this chunk.")
+            continue
+        if isinstance(chunk_questions, list):
+            questions.extend(chunk_questions)
+
+    return orjson.dumps(questions).decode()
+
+# Join the non-empty replies to a message into the answer text passed to the answers prompt
+def answer_text(item):
+    return ' '.join(reply['replyContent'] for reply in item['replies'] if reply.get('replyContent'))
+
+# Write the JSON file for a pair of generated questions and answers, if both are valid JSON
+async def write_qa_pair(output_dir, counter, item, questions, answers):
+    message_id = item['messageId']
+    print("Message ID:", message_id)
+    print("Questions:", questions)
+    print("Answers:", answers)
+
+    # Parse the questions and answers once, skipping this pair if either is not valid JSON or not in the
+    # expected shape. A bad response only skips this message rather than failing every concurrent task.
+    try:
+        question_list = [{"Q" + str(counter): question["question"]} for question in orjson.loads(questions)]
+        answer_list = [{"A" + str(counter): answer["answer"]} for answer in orjson.loads(answers)]
+    except orjson.JSONDecodeError as e:
+        print(f"Invalid JSON returned from chat function ({e}), skipping this pair.")
+        return
+    except (KeyError, TypeError) as e:
+        print(f"Unexpected JSON structure returned from chat function ({e!r}), skipping this pair.")
+        return
+
+    # Create a dictionary for this pair of questions and answers
+    pair = {
+        "Questions": question_list,
+        "Answers": answer_list
+    }
+
+    # Create a new file for each pair. The write is asynchronous so it doesn't block the event loop
+    # while other messages' requests are in flight.
+    async with aiofiles.open(os.path.join(output_dir, f'qna_{counter}.json'), 'wb') as f:
+        await f.write(orjson.dumps(pair, option=orjson.OPT_INDENT_2))
+
+# Generate and write the Q&A pair for a single message. The questions for each chunk of the message
+# are generated concurrently and merged. The answers request depends on the questions, so it runs after them;
+# the semaphore bounds the requests in flight across all messages.
+async def _process(item, chunks, counter, sem, output_dir):
+    questions = merge_questions(await asyncio.gather(*[generate_qna(chunk, question_prompt, sem) for chunk in chunks]))
+    answers = await generate_qna(questions + '\n' + answer_text(item), answers_prompt, sem)
+    await write_qa_pair(output_dir, counter, item, questions, answers)
+
+async def extract_qa_pairs(input_file, output_dir, max_concurrent):
+    items = load_items(input_file)
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    # Split the messages into chunks before starting any requests, so a tokenizer failure stops the run up front
+    chunks_all = [chunk_text(item['messageContent']) for item in items]
+
+    # Process all messages concurrently. Each message is numbered up front so its output file name
+    # doesn't depend on the order in which the messages complete.
+    await asyncio.gather(*[
+        _process(item, chunks, counter, semaphore, output_dir)
+        for counter, (item, chunks) in enumerate(zip(items, chunks_all))
+    ])
+
+# Send a request to the Azure OpenAI REST API, e.g. path='batches', and return the response
+def azure_openai_request(method, path, **kwargs):
+    response = requests.request(
+        method,
+        f"{_ENDPOINT.rstrip('/')}/openai/{path}",
+        params={"api-version": _API_VERSION},
+        headers={"api-key": _API_KEY},
+        **kwargs,
+    )
+    response.raise_for_status()
+    return response
+
+# Run chat completions through the Batch API: run_batch() uploads the requests as a JSONL file,
+# waits for the file to be processed, submits a batch job, polls until it finishes, and returns the
+# generated content for each request in order. Requests that failed or did not complete fall back
+# to an empty JSON string.
+async def run_batch(inputs, prompt):
+    if not inputs:
+        return []
+
+    lines = [
+        json.dumps({
+            "custom_id": str(index),
+            "method": "POST",
+            "url": "/chat/completions",
+            "body": {
+                "model": _ENGINE,
+                "messages": [
+                    {"role": "system", "content": prompt},
+                    {"role": "user", "content": input},
+                ],
+                "max_tokens": 4096,
+                "n": 1,
+                "temperature": 0.1,
+                "top_p": 0.1,
+            },
+        })
+        for index, input in enumerate(inputs)
+    ]
+
+    input_file = azure_openai_request(
+        "post", "files",
+        data={"purpose": "batch"},
+        files={"file": ("batch_input.jsonl", '\n'.join(lines).encode())},
+    ).json()
+
+    # The batch can only be created once the uploaded file has been validated and processed
+    while input_file["status"] not in ("processed", "error", "deleted"):
+        await asyncio.sleep(file_poll_interval)
+        input_file = azure_openai_request("get", f"files/{input_file['id']}").json()
+        print(f"Batch input file {input_file['id']} status: {input_file['status']}")
+
+    if input_file["status"] != "processed":
+        print(f"Batch input file {input_file['id']} was not processed: {input_file.get('status_details')}")
+        return ["{}"] * len(inputs)  # Empty JSON strings as a fallback
+
+    batch = azure_openai_request("post", "batches", json={
+        "input_file_id": input_file["id"],
+        "endpoint": "/chat/completions",
+        "completion_window": "24h",
+    }).json()
+    print(f"Submitted batch {batch['id']} with {len(lines)} requests.")
+
+    while batch["status"] not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(batch_poll_interval)
+        batch = azure_openai_request("get", f"batches/{batch['id']}").json()
+        print(f"Batch {batch['id']} status: {batch['status']}")
+
+    results = ["{}"] * len(inputs)  # Empty JSON strings as a fallback
+
+    # Expired batches may still have completed some of their requests
+    if batch.get("output_file_id"):
+        output = azure_openai_request("get", f"files/{batch['output_file_id']}/content").text
+        for line in output.splitlines():
+            if not line:
+                continue
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if response.get("status_code") == 200:
+                results[int(result["custom_id"])] = response["body"]["choices"][0]["message"]["content"]
+            else:
+                print(f"Batch request {result['custom_id']} failed: {result.get('error')}")
+    else:
+        print(f"Batch {batch['id']} {batch['status']} without any output.")
+
+    return results
+
+async def extract_qa_pairs_batch(input_file, output_dir):
+    items = load_items(input_file)
+
+    # Run the questions batch first, then the answers batch, since each answer depends on its questions.
+    # Each chunk of a message is a separate request; their questions are merged per message.
+    chunks_all = [chunk_text(item['messageContent']) for item in items]
+    results = await run_batch([chunk for chunks in chunks_all for chunk in chunks], question_prompt)
+
+    questions_all = []
+    offset = 0
+    for chunks in chunks_all:
+        questions_all.append(merge_questions(results[offset:offset + len(chunks)]))
+        offset += len(chunks)
+
+    answers_all = await run_batch(
+        [questions + '\n' + answer_text(item) for item, questions in zip(items, questions_all)],
+        answers_prompt,
+    )
+
+    for counter, (item, questions, answers) in enumerate(zip(items, questions_all, answers_all)):
+        await write_qa_pair(output_dir, counter, item, questions, answers)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Extract question/answer pairs from JSON data.')
     parser.add_argument('input_file', type=str, help='Path to the input JSON file.')
     parser.add_argument('output_dir', type=str, help='Path to the output directory.')
+    parser.add_argument('--max-concurrent', type=int, default=8, help='Maximum number of concurrent OpenAI API requests.')
+    parser.add_argument('--batch', action='store_true', help='Use the Batch API instead of real-time requests. Results may take up to 24 hours.')
 
     args = parser.parse_args()
 
-    asyncio.run(extract_qa_pairs(args.input_file, args.output_dir))
\ No newline at end of file
+    check_config()
+
+    if args.batch:
+        asyncio.run(extract_qa_pairs_batch(args.input_file, args.output_dir))
+    else:
+        asyncio.run(extract_qa_pairs(args.input_file, args.output_dir, args.max_concurrent))
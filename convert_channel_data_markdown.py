@@ -12,6 +12,7 @@ The script uses environment variables for OpenAI API configuration, which should
 1. 'AZURE_OPENAI_API_KEY': The OpenAI API key.
 2. 'AZURE_OPENAI_ENDPOINT': The OpenAI API endpoint.
 3. 'AZURE_OPENAI_DEPLOYMENT_NAME': The name of the OpenAI deployment.
+4. 'AZURE_OPENAI_API_VERSION': The OpenAI API version.
 
 How to run:
 1. Ensure that all the necessary Python libraries are installed and the .env file is set up correctly.
@@ -23,8 +24,10 @@ License: MIT
 """
 
 import json
+import orjson
 import os
 import re
+import sys
 import argparse
 import openai
 import asyncio
@@ -33,10 +36,28 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-openai.api_key = os.getenv("AZURE_OPENAI_API_KEY")
-openai.api_base = os.getenv("AZURE_OPENAI_ENDPOINT")
+# Read the Azure OpenAI configuration once rather than on every request
+_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
+_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
+_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION")
+_ENGINE = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
+
+openai.api_key = _API_KEY
+openai.api_base = _ENDPOINT
 openai.api_type = "azure"
-openai.api_version = os.get("AZURE_OPENAI_API_VERSION")
+openai.api_version = _API_VERSION
+
+# Check that all of the Azure OpenAI configuration is set, rather than passing None into the OpenAI client
+def check_config():
+    missing = [name for name, value in (
+        ("AZURE_OPENAI_API_KEY", _API_KEY),
+        ("AZURE_OPENAI_ENDPOINT", _ENDPOINT),
+        ("AZURE_OPENAI_API_VERSION", _API_VERSION),
+        ("AZURE_OPENAI_DEPLOYMENT_NAME", _ENGINE),
+    ) if not value]
+    if missing:
+        print(f"Missing environment variables: {', '.join(missing)}. Set them in the .env file.", file=sys.stderr)
+        sys.exit(1)
 
 # # Define a prompt for OpenAI API to generate questions and 
 question_prompt = """Given the following input, extract and summarize the questions being asked. Clean up the formatting to remove extraneous characters and improve readability. Distill each question down to the essence of what is being asked, removing extraneous information and formatting. Do not include anyone's names in the output. Format the output using the following template, with each question forming a unique item as shown in the example below:
@@ -58,15 +79,6 @@ answers_prompt = """Given the following question and answers, extract and synthe
   ...
 """
 
-# Check if a string is a valid JSON object
-def is_valid_json(json_string):
-    try:
-        json.loads(json_string)
-        return True
-    except ValueError:
-        print("Invalid JSON:", json_string)
-        return False
-
 # Generate questions and answers: generate_qna() is an async 
 # function that sends request to OpenAI API to generate QnA based on input.
 # Retries request if response is invalid, up to a maximum number of attempts.
@@ -80,7 +92,7 @@ async def generate_qna(input, prompt):
         try:
             print(f"Attempt {retry_count + 1} of {max_retries}...")
             response = openai.ChatCompletion.create(
-                engine=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
+                engine=_ENGINE,
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": input},
@@ -136,8 +148,7 @@ async def extract_qa_pairs(input_file, output_dir):
         message_id = item['messageId']
         message_content = item['messageContent']
         replies = item['replies']
-        answers = [reply['replyContent'] for reply in replies]
-        answer_content = ' '.join(answers)
+        answer_content = ' '.join(reply['replyContent'] for reply in replies if reply.get('replyContent'))
 
         questions = await generate_qna(message_content, question_prompt)
         answers = await generate_qna(questions + '\n' + answer_content, answers_prompt)
@@ -145,11 +156,14 @@ async def extract_qa_pairs(input_file, output_dir):
         print("Questions:", questions)
         print("Answers:", answers)
 
-        # Create a dictionary for this pair of questions and answers
-        if (is_valid_json(questions) and is_valid_json(answers)):
-            question_list = json.loads(questions)
-            answer_list = json.loads(answers)
-                
+        # Parse the questions and answers once, skipping this pair if either is not valid JSON
+        try:
+            question_list = orjson.loads(questions)
+            answer_list = orjson.loads(answers)
+        except orjson.JSONDecodeError as e:
+            print(f"Invalid JSON returned from chat function ({e}), skipping this pair.")
+            continue
+
         for question, answer in zip(question_list, answer_list):
             # Check if 'question' and 'answer' exist before trying to access them
             if 'question' in question and 'answer' in answer:
@@ -167,8 +181,6 @@ async def extract_qa_pairs(input_file, output_dir):
             # Write the markdown content to a file
             with open(os.path.join(output_dir, f'typespec_channel_qna_{file_counter}.md'), 'w') as f:
                 f.write(markdown_content)
-        else:
-            print("Invalid JSON returned from chat function, skipping this pair.")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Extract question/answer pairs from JSON data.')
@@ -177,4 +189,6 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
+    check_config()
+
     asyncio.run(extract_qa_pairs(args.input_file, args.output_dir))
\ No newline at end of file